@@ -16,9 +16,14 @@ __author__ = 'Alec Thomas <alec@swapoff.org>'
 
 
 from Queue import Empty
-from redis import Redis
-from cut.serialize import Serializable
+from contextlib import contextmanager
+from redis import BlockingConnectionPool, ConnectionPool, Redis
+from cut.serialize import JSONCodec, MsgPackCodec, Serializable, Serializer
+import math
+import random
+import threading
 import time
+import uuid
 
 
 class DistributedError(Exception):
@@ -32,45 +37,159 @@ class LockTimeout(DistributedError):
 class _DistributedBase(object):
     """Base class for distributed objects."""
 
+    __slots__ = ('key', '_key_b', '_redis')
+
+    # Only the key is serialized; connection state is local.
+    __fields__ = ('key',)
+
     def __init__(self, key=None, redis=None, namespace=None):
         if key is None:
-            key = str(Counter(':keys', redis=redis).increment())
+            # increment_many() is never deferred by batch().
+            key = str(Counter(':keys', redis=redis).increment_many(1)[0])
         self.key = key
         namespace = namespace or self.__class__.__name__.lower()
-        self._key = 'distributed:%s:%s' % (namespace, self.key)
+        # Encoded once here rather than by the client on every command; this
+        # only saves work for unicode keys, as str keys are already bytes.
+        self._key_b = _encode_key(
+            'distributed:%s:%s' % (namespace, self.key))
         self._redis = redis or _connection
 
+    def __deserialize__(self, state):
+        # Reconnect to the same key with default options.
+        self.__init__(**dict((str(k), v) for k, v in state.iteritems()))
+
+    def _eval(self, source, keys, args):
+        """Evaluate a Lua script, using EVALSHA once it has been loaded."""
+        script = _scripts.get(source)
+        if script is None:
+            script = _scripts[source] = self._redis.register_script(source)
+        return script(keys=keys, args=args, client=self._redis)
+
+    def _client(self):
+        """The thread's active batch() pipeline, or else the connection."""
+        pipe = getattr(_local, 'pipeline', None)
+        if pipe is not None and _local.redis is self._redis:
+            return pipe
+        return self._redis
+
 
 class Queue(_DistributedBase, Serializable):
-    """A distributed Queue."""
+    """A distributed Queue.
+
+    If batch_size is given, put() buffers items locally and pushes them to
+    Redis in a single round-trip once batch_size items have accumulated. Call
+    flush() to push any items remaining in the buffer. The buffer may be
+    shared between threads.
+    """
+
+    __slots__ = ('_batch_size', '_buffer', '_buffer_lock')
+
+    def __init__(self, key=None, redis=None, namespace=None,
+                 batch_size=None):
+        super(Queue, self).__init__(key, redis, namespace)
+        self._batch_size = batch_size
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
 
     def qsize(self):
-        return self._redis.llen(self._key)
+        return self._redis.llen(self._key_b)
 
     def empty(self):
         return not self.qsize()
 
     def put(self, item):
-        self._redis.rpush(self._key, dumps(item))
+        if not self._batch_size:
+            self._client().rpush(self._key_b, dumps(item))
+            return
+        with self._buffer_lock:
+            self._buffer.append(item)
+            full = len(self._buffer) >= self._batch_size
+        if full:
+            self.flush()
+
+    def put_many(self, items):
+        """Put a sequence of items on the queue in a single round-trip."""
+        values = [dumps(item) for item in items]
+        if values:
+            self._client().rpush(self._key_b, *values)
+
+    def flush(self):
+        """Push any items buffered by put() to Redis."""
+        with self._buffer_lock:
+            items, self._buffer = self._buffer, []
+        self.put_many(items)
 
     def get(self, block=True, timeout=None):
-        if block:
-            value = self._redis.blpop(self._key, timeout=timeout or 0)
+        """Remove and return an item from the queue.
+
+        :param timeout: If blocking, the maximum time in seconds to wait,
+                        rounded up to whole seconds. 0 does not wait.
+        :raises Empty: No item was available.
+        """
+        if block and timeout != 0:
+            value = self._redis.blpop(self._key_b,
+                                      timeout=_blpop_timeout(timeout))
             if value is not None:
                 value = value[1]
         else:
-            value = self._redis.lpop(self._key)
+            value = self._redis.lpop(self._key_b)
         if value is None:
             raise Empty()
         return loads(value)
 
+    def get_many(self, n, block=True, timeout=None):
+        """Get up to n items from the queue.
+
+        Available items are drained atomically in a single round-trip. If
+        blocking and the queue is empty, waits for the first item then drains
+        the remainder. Timeouts are handled as for get().
+
+        :raises Empty: No items were available.
+        :raises ValueError: n is less than 1.
+        """
+        if n < 1:
+            raise ValueError('n must be at least 1, not %r' % n)
+        values = self._eval(_DRAIN_LUA, [self._key_b], [n])
+        if not values and block and timeout != 0:
+            value = self._redis.blpop(self._key_b,
+                                      timeout=_blpop_timeout(timeout))
+            if value is not None:
+                values = [value[1]]
+                if n > 1:
+                    values.extend(
+                        self._eval(_DRAIN_LUA, [self._key_b], [n - 1]))
+        if not values:
+            raise Empty()
+        return [loads(value) for value in values]
+
 
 class Counter(_DistributedBase, Serializable):
     """An ever-incrementing counter, guaranteed to be unique."""
 
+    __slots__ = ()
+
+    def __init__(self, key=None, redis=None, namespace=None):
+        super(Counter, self).__init__(key, redis, namespace)
+
     def increment(self):
-        """Increment the counter and return its current value."""
-        return self._redis.incr('distributed:counter:' + self.key)
+        """Increment the counter and return its current value.
+
+        Inside batch() the increment is deferred and None is returned.
+        """
+        client = self._client()
+        value = client.incr(self._key_b)
+        return value if client is self._redis else None
+
+    def increment_many(self, count):
+        """Increment the counter count times in a single round-trip.
+
+        :returns: A list of the count unique values allocated.
+        :raises ValueError: count is less than 1.
+        """
+        if count < 1:
+            raise ValueError('count must be at least 1, not %r' % count)
+        last = self._redis.incrby(self._key_b, count)
+        return range(last - count + 1, last + 1)
 
 
 class Event(_DistributedBase, Serializable):
@@ -81,35 +200,55 @@ class Event(_DistributedBase, Serializable):
         the event. If the key does not exist, the event is not set. If it
         exists, it is set.
 
-        When an event is set(), the key is set to a value and a pubsub event
-        sent under the channel distributed:event:<key>.
+        Waiters atomically check the state and, if it is not set, increment
+        distributed:event:<key>:waiters, then BLPOP
+        distributed:event:<key>:notify. When an event is set(), the key is
+        set and one notification per registered waiter is pushed onto the
+        notify list, atomically. Waiters that time out unregister themselves,
+        or consume their notification if set() already counted them.
+
+        clear() only deletes the state key. Notifications already pushed by
+        set() are left for the waiters they were counted for, so those
+        waiters still wake and return True even if the event was cleared in
+        between, as with threading.Event.
     """
 
-    def wait(self):
-        if self.is_set():
+    __slots__ = ('_notify_key', '_waiters_key')
+
+    def __init__(self, key=None, redis=None, namespace=None):
+        super(Event, self).__init__(key, redis, namespace)
+        self._notify_key = self._key_b + b':notify'
+        self._waiters_key = self._key_b + b':waiters'
+
+    def wait(self, timeout=None):
+        """Wait for the event to be set.
+
+        :param timeout: Optional timeout in seconds. Redis only supports whole
+                        seconds, so fractional timeouts are rounded up. A
+                        timeout of 0 checks the state without waiting.
+        :returns: True if the event is set, False on timeout.
+        """
+        if timeout == 0:
+            return bool(self.is_set())
+        if self._eval(_WAIT_EVENT_LUA, [self._key_b, self._waiters_key], []):
             return True
-        # TODO: There is a race-condition here. A pubsub message may be sent
-        # after checking is_set() and before starting the pubsub listen.
-        pubsub = self._redis.pubsub()
-        pubsub.subscribe(self._key)
-        try:
-            if self.is_set():
-                return True
-            for m in pubsub.listen():
-                if m['type'] == 'message':
-                    return True
-        finally:
-            pubsub.unsubscribe(self._key)
+        seconds = _blpop_timeout(timeout)
+        if self._redis.blpop(self._notify_key, timeout=seconds) is not None:
+            return True
+        return bool(self._eval(
+            _UNWAIT_EVENT_LUA,
+            [self._waiters_key, self._key_b, self._notify_key], []))
 
     def is_set(self):
-        return self._redis.exists(self._key)
+        return self._redis.exists(self._key_b)
 
     def set(self):
-        self._redis.set(self._key, '1')
-        self._redis.publish(self._key, '1')
+        self._eval(_SET_EVENT_LUA,
+                   [self._key_b, self._waiters_key, self._notify_key],
+                   [_NOTIFY_EXPIRES])
 
     def clear(self):
-        self._redis.delete(self._key)
+        self._redis.delete(self._key_b)
 
 
 class Lock(_DistributedBase, Serializable):
@@ -118,42 +257,53 @@ class Lock(_DistributedBase, Serializable):
     # Code from retools:
     # https://github.com/bbangert/retools/blob/master/retools/lock.py
 
+    __slots__ = ('_expires', '_timeout', '_token', '_release_key')
+
     def __init__(self, key=None, expires=60, timeout=10, redis=None):
         super(Lock, self).__init__(key, redis)
         self._expires = expires
         self._timeout = timeout
-        self._start_time = time.time()
+        self._token = None
+        self._release_key = self._key_b + b':release'
 
     def acquire(self, blocking=True):
-        timeout = self._timeout
-        while timeout >= 0:
-            expires = time.time() + self._expires + 1
-
-            if self._redis.setnx(self._key, expires):
-                # We gained the lock; enter critical section
-                self._start_time = time.time()
-                return True
-
-            current_value = self._redis.get(self._key)
-
-            # We found an expired lock and nobody raced us to replacing it
-            if current_value and float(current_value) < time.time() and \
-                    self._redis.getset(self._key, expires) == current_value:
-                self._start_time = time.time()
-                return True
-
-            if not blocking:
-                return False
+        deadline = time.time() + self._timeout
+        attempt = 0
+        pubsub = None
+        try:
+            token = uuid.uuid4().hex
+            args = [token, int(self._expires * 1000)]
+            while True:
+                if self._eval(_ACQUIRE_LUA, [self._key_b], args):
+                    # We gained the lock; enter critical section
+                    self._token = token
+                    return True
 
-            timeout -= 1
-            time.sleep(1)
-        return False
+                if not blocking:
+                    return False
+
+                if pubsub is None:
+                    # Subscribe for release notifications, then retry
+                    # immediately in case the lock was released meanwhile.
+                    pubsub = self._redis.pubsub()
+                    pubsub.subscribe(self._release_key)
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                _wait_for_message(pubsub, min(remaining, _backoff(attempt)))
+                attempt += 1
+        finally:
+            if pubsub is not None:
+                pubsub.close()
 
     def release(self):
-        # Only delete the key if we completed within the lock expiration,
-        # otherwise, another lock might've been established
-        if time.time() - self._start_time < self._expires:
-            self._redis.delete(self._key)
+        # Only delete the key if it still holds our token, otherwise our lock
+        # expired and another might've been established
+        token, self._token = self._token, None
+        if token is not None:
+            self._eval(_RELEASE_LUA, [self._key_b, self._release_key], [token])
 
     def __enter__(self):
         if not self.acquire():
@@ -163,11 +313,164 @@ class Lock(_DistributedBase, Serializable):
         return self.release()
 
 
+# Take the lock if it is free, storing our token with a millisecond expiry.
+_ACQUIRE_LUA = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+# Release the lock only if it holds our token, and wake waiters.
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('PUBLISH', KEYS[2], '')
+    return 1
+end
+return 0
+"""
+
+# Atomically pop up to ARGV[1] items from the head of a list.
+_DRAIN_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, ARGV[1] - 1)
+redis.call('LTRIM', KEYS[1], ARGV[1], -1)
+return items
+"""
+
+# Return 1 if an event is set, otherwise register as a waiter and return 0.
+_WAIT_EVENT_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 1
+end
+redis.call('INCR', KEYS[2])
+return 0
+"""
+
+# Set an event and push one notification for each registered waiter.
+_SET_EVENT_LUA = """
+redis.call('SET', KEYS[1], '1')
+local waiters = tonumber(redis.call('GETSET', KEYS[2], 0) or 0)
+for i = 1, waiters do
+    redis.call('RPUSH', KEYS[3], '')
+end
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+return waiters
+"""
+
+# Unregister a timed out waiter. If set() has already reset the waiter count,
+# it pushed a notification for us, so consume that instead.
+_UNWAIT_EVENT_LUA = """
+if tonumber(redis.call('GET', KEYS[1]) or 0) > 0 then
+    redis.call('DECR', KEYS[1])
+else
+    redis.call('LPOP', KEYS[3])
+end
+return redis.call('EXISTS', KEYS[2])
+"""
+
+# Seconds unclaimed event notifications are kept for.
+_NOTIFY_EXPIRES = 60
+
+# Lock retry backoff bounds, in seconds.
+_BACKOFF_BASE = 0.01
+_BACKOFF_CAP = 1.0
+
+
+def _backoff(attempt):
+    """Exponential backoff with full jitter."""
+    return min(_BACKOFF_CAP, _BACKOFF_BASE * 2 ** attempt) * random.random()
+
+
+def _wait_for_message(pubsub, timeout):
+    """Wait up to timeout seconds for a message on a subscribed channel."""
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        message = pubsub.get_message(ignore_subscribe_messages=True,
+                                     timeout=remaining)
+        if message is not None:
+            return True
+
+
+def _blpop_timeout(timeout):
+    """Convert a timeout in seconds, or None, to a BLPOP timeout.
+
+    BLPOP treats 0 as "wait forever", and before Redis 6 only accepts whole
+    seconds, so timeouts are rounded up.
+    """
+    if timeout is None:
+        return 0
+    return int(math.ceil(timeout))
+
+
+def _encode_key(key):
+    """Encode a Redis key to bytes."""
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
+
+
+def dumps(data):
+    """Serialize data into the wire format used for Redis values."""
+    return _serializer.serialize(data)
+
+
+def loads(raw):
+    """Deserialize a Redis value produced by dumps()."""
+    return _serializer.deserialize(raw)
+
+
+# Wire formats selectable with init(codec=...). Values carry no codec tag,
+# so every producer and consumer of a key must use the same one; msgpack is
+# therefore required rather than optional.
+_codecs = {
+    'msgpack': MsgPackCodec(),
+    'json': JSONCodec(),
+}
+_DEFAULT_CODEC = 'msgpack'
+_serializer = Serializer(_codecs[_DEFAULT_CODEC])
+
 # Global Redis connections
 _connection = None
+# Per-thread state for batch()
+_local = threading.local()
+# Registered Lua scripts, keyed by source
+_scripts = {}
+
 
+@contextmanager
+def batch(redis=None):
+    """Defer writes from this thread into a single pipelined round-trip.
 
-def init(host='localhost', port=6379, db=0):
+    Queue.put() and Counter.increment() calls made within the block are
+    queued on a pipeline that is executed when the block exits cleanly.
+
+        >>> with batch():
+        ...     for item in items:
+        ...         queue.put(item)
+
+    :param redis: Connection to batch commands for. Defaults to the global
+                  connection.
+    """
+    redis = redis or _connection
+    if getattr(_local, 'pipeline', None) is not None:
+        # Nested batches join the outermost one.
+        yield _local.pipeline
+        return
+    pipe = redis.pipeline(transaction=False)
+    _local.pipeline, _local.redis = pipe, redis
+    try:
+        yield pipe
+    finally:
+        _local.pipeline = _local.redis = None
+    pipe.execute()
+
+
+def init(host='localhost', port=6379, db=0, codec=_DEFAULT_CODEC,
+         max_connections=None):
     """Initialize global distributed state.
 
     Must be called before any distributed primitives can be used.
@@ -175,6 +478,26 @@ def init(host='localhost', port=6379, db=0):
     :param host: Redis host.
     :param port: Redis port.
     :param db: Redis DB slot.
+    :param codec: Wire format for values, either "msgpack" or "json". JSON
+                  is useful when consumers in other languages require text.
+                  All processes sharing keys must use the same codec.
+    :param max_connections: Optional cap on the connection pool size. When
+                            all connections are in use, callers wait for
+                            one to be released. Blocking Queue.get(),
+                            Event.wait() and contended Lock.acquire() calls
+                            each hold a connection, so the cap should exceed
+                            the number of concurrent waiters. Unbounded by
+                            default.
     """
-    global _connection
-    _connection = Redis(host, port, db)
+    global _connection, _serializer
+    if codec not in _codecs:
+        raise DistributedError('unknown codec %r' % codec)
+    if max_connections is None:
+        pool = ConnectionPool(host=host, port=port, db=db,
+                              socket_keepalive=True)
+    else:
+        pool = BlockingConnectionPool(host=host, port=port, db=db,
+                                      max_connections=max_connections,
+                                      timeout=None, socket_keepalive=True)
+    _connection = Redis(connection_pool=pool)
+    _serializer = Serializer(_codecs[codec])
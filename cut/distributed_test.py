@@ -0,0 +1,283 @@
+# encoding: utf-8
+#
+# Copyright (C) 2010 Alec Thomas <alec@swapoff.org>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: Alec Thomas <alec@swapoff.org>
+
+"""Tests for distributed primitives.
+
+These require a Redis server on localhost:6379, and use (and flush) DB 15.
+They are skipped if Redis is not reachable.
+"""
+
+__author__ = 'Alec Thomas <alec@swapoff.org>'
+
+
+import threading
+import time
+import unittest
+from Queue import Empty
+
+try:
+    import redis
+    from cut import distributed
+    from cut.distributed import Counter, Event, Lock, LockTimeout, Queue
+    redis.Redis(db=15).ping()
+except Exception:
+    # Missing client libraries or no server; either way, skip.
+    redis = None
+
+
+class RedisTestCase(unittest.TestCase):
+    def setUp(self):
+        if redis is None:
+            self.skipTest('Redis is not available')
+        self.redis = redis.Redis(db=15)
+        self.redis.flushdb()
+
+
+class TestQueue(RedisTestCase):
+    def test_namespace(self):
+        queue = Queue('q', self.redis, namespace='custom')
+        queue.put(1)
+        self.assertEqual(self.redis.llen('distributed:custom:q'), 1)
+
+    def test_put_many(self):
+        queue = Queue('q', self.redis)
+        queue.put_many([1, 'two', {'three': 3}])
+        self.assertEqual([queue.get(False) for _ in range(3)],
+                         [1, 'two', {'three': 3}])
+
+    def test_buffered_put(self):
+        queue = Queue('q', self.redis, batch_size=3)
+        queue.put(1)
+        queue.put(2)
+        self.assertEqual(queue.qsize(), 0)
+        queue.put(3)
+        self.assertEqual(queue.qsize(), 3)
+        queue.put(4)
+        queue.flush()
+        self.assertEqual(queue.qsize(), 4)
+
+    def test_buffered_put_from_threads_loses_nothing(self):
+        queue = Queue('q', self.redis, batch_size=7)
+
+        def producer(start):
+            for i in range(start, start + 500):
+                queue.put(i)
+
+        threads = [threading.Thread(target=producer, args=(i * 500,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        queue.flush()
+        self.assertEqual(queue.qsize(), 4000)
+
+    def test_get_many_drains_up_to_n(self):
+        queue = Queue('q', self.redis)
+        queue.put_many(range(5))
+        self.assertEqual(queue.get_many(3), [0, 1, 2])
+        self.assertEqual(queue.get_many(3), [3, 4])
+        self.assertEqual(queue.qsize(), 0)
+        self.assertRaises(Empty, queue.get_many, 3, False)
+
+    def test_get_many_rejects_non_positive(self):
+        queue = Queue('q', self.redis)
+        queue.put(1)
+        self.assertRaises(ValueError, queue.get_many, 0)
+        self.assertRaises(ValueError, queue.get_many, -1)
+        self.assertEqual(queue.qsize(), 1)
+
+    def test_get_many_blocks_for_first_item(self):
+        queue = Queue('q', self.redis)
+
+        def produce():
+            time.sleep(0.2)
+            queue.put_many(['a', 'b', 'c'])
+
+        threading.Thread(target=produce).start()
+        self.assertEqual(queue.get_many(2, timeout=5), ['a', 'b'])
+        self.assertEqual(queue.get_many(2, timeout=5), ['c'])
+
+    def test_fractional_timeout(self):
+        queue = Queue('q', self.redis)
+        start = time.time()
+        self.assertRaises(Empty, queue.get_many, 2, True, 0.5)
+        self.assertRaises(Empty, queue.get, True, 0.5)
+        # Rounded up to one second each, never "block forever".
+        self.assertLess(time.time() - start, 3)
+
+    def test_zero_timeout_does_not_block(self):
+        queue = Queue('q', self.redis)
+        start = time.time()
+        self.assertRaises(Empty, queue.get_many, 2, True, 0)
+        self.assertRaises(Empty, queue.get, True, 0)
+        self.assertLess(time.time() - start, 0.5)
+
+
+class TestCounter(RedisTestCase):
+    def test_key(self):
+        Counter('c', self.redis).increment()
+        Counter('c', self.redis, namespace='custom').increment_many(2)
+        self.assertEqual(self.redis.get('distributed:counter:c'), b'1')
+        self.assertEqual(self.redis.get('distributed:custom:c'), b'2')
+
+    def test_increment_many(self):
+        counter = Counter('c', self.redis)
+        self.assertEqual(counter.increment(), 1)
+        self.assertEqual(counter.increment_many(3), [2, 3, 4])
+        self.assertEqual(counter.increment(), 5)
+
+    def test_increment_many_rejects_non_positive(self):
+        counter = Counter('c', self.redis)
+        self.assertRaises(ValueError, counter.increment_many, 0)
+        self.assertRaises(ValueError, counter.increment_many, -1)
+
+
+class TestEvent(RedisTestCase):
+    def _wait_in_thread(self, event):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(event.wait(5)))
+        thread.start()
+        # Wait until the waiter has registered.
+        while int(self.redis.get('distributed:event:e:waiters') or 0) < 1:
+            time.sleep(0.01)
+        return thread, result
+
+    def test_namespace(self):
+        Event('e', self.redis, namespace='custom').set()
+        self.assertTrue(self.redis.exists('distributed:custom:e'))
+
+    def test_wait_on_set_event_does_not_register(self):
+        event = Event('e', self.redis)
+        event.set()
+        self.assertTrue(event.wait(1))
+        self.assertTrue(event.wait())
+        self.assertEqual(self.redis.get('distributed:event:e:waiters'), b'0')
+
+    def test_set_wakes_waiter(self):
+        event = Event('e', self.redis)
+        thread, result = self._wait_in_thread(event)
+        event.set()
+        thread.join()
+        self.assertEqual(result, [True])
+
+    def test_clear_does_not_lose_wakeup(self):
+        event = Event('e', self.redis)
+        # A waiter that has registered but not yet reached BLPOP.
+        self.redis.incr('distributed:event:e:waiters')
+        event.set()
+        event.clear()
+        self.assertFalse(event.is_set())
+        self.assertIsNotNone(
+            self.redis.blpop('distributed:event:e:notify', timeout=1))
+
+    def test_wait_times_out(self):
+        event = Event('e', self.redis)
+        self.assertFalse(event.wait(0))
+        self.assertFalse(event.wait(0.1))
+        self.assertEqual(self.redis.get('distributed:event:e:waiters'), b'0')
+
+
+class TestBatch(RedisTestCase):
+    def test_commands_are_deferred_until_exit(self):
+        queue = Queue('q', self.redis)
+        counter = Counter('c', self.redis)
+        with distributed.batch(self.redis):
+            queue.put(1)
+            queue.put(2)
+            self.assertEqual(counter.increment(), None)
+            self.assertEqual(self.redis.llen('distributed:queue:q'), 0)
+            self.assertFalse(self.redis.exists('distributed:counter:c'))
+        self.assertEqual(queue.get_many(2), [1, 2])
+        self.assertEqual(counter.increment(), 2)
+
+    def test_commands_are_discarded_on_exception(self):
+        queue = Queue('q', self.redis)
+
+        def fail():
+            with distributed.batch(self.redis):
+                queue.put(1)
+                raise RuntimeError('boom')
+
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(queue.qsize(), 0)
+        # The thread is no longer batching.
+        queue.put(2)
+        self.assertEqual(queue.qsize(), 1)
+
+
+class TestLock(RedisTestCase):
+    def test_acquire_release(self):
+        lock = Lock('l', redis=self.redis)
+        self.assertTrue(lock.acquire())
+        lock.release()
+        self.assertFalse(self.redis.exists('distributed:lock:l'))
+
+    def test_release_without_token_does_not_delete(self):
+        held = Lock('l', redis=self.redis)
+        self.assertTrue(held.acquire())
+        Lock('l', redis=self.redis).release()
+        self.assertTrue(self.redis.exists('distributed:lock:l'))
+
+    def test_release_with_foreign_token_does_not_delete(self):
+        lock = Lock('l', redis=self.redis)
+        self.assertTrue(lock.acquire())
+        # Our lock expired and another holder took it.
+        self.redis.set('distributed:lock:l', 'other')
+        lock.release()
+        self.assertEqual(self.redis.get('distributed:lock:l'), b'other')
+
+    def test_held_lock_is_not_acquired(self):
+        held = Lock('l', redis=self.redis)
+        self.assertTrue(held.acquire())
+        other = Lock('l', redis=self.redis, timeout=0.2)
+        self.assertFalse(other.acquire(blocking=False))
+        start = time.time()
+        self.assertFalse(other.acquire())
+        self.assertTrue(0.15 < time.time() - start < 1.0)
+
+    def test_release_wakes_waiter(self):
+        held = Lock('l', redis=self.redis)
+        self.assertTrue(held.acquire())
+        result = []
+        waiter = Lock('l', redis=self.redis, timeout=10)
+        original_backoff = distributed._backoff
+        # Only a release notification can wake the waiter in time.
+        distributed._backoff = lambda attempt: 10
+        try:
+            thread = threading.Thread(
+                target=lambda: result.append(waiter.acquire()))
+            thread.start()
+            time.sleep(0.2)
+            start = time.time()
+            held.release()
+            thread.join(5)
+        finally:
+            distributed._backoff = original_backoff
+        self.assertEqual(result, [True])
+        self.assertLess(time.time() - start, 1)
+
+    def test_context_manager_times_out(self):
+        Lock('l', redis=self.redis).acquire()
+
+        def enter():
+            with Lock('l', redis=self.redis, timeout=0.1):
+                pass
+
+        self.assertRaises(LockTimeout, enter)
+
+    def test_expired_lock_is_acquired(self):
+        self.assertTrue(Lock('l', expires=0.1, redis=self.redis).acquire())
+        other = Lock('l', redis=self.redis, timeout=2)
+        self.assertTrue(other.acquire())
+
+
+if __name__ == '__main__':
+    unittest.main()
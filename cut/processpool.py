@@ -0,0 +1,97 @@
+# encoding: utf-8
+#
+# Copyright (C) 2010 Alec Thomas <alec@swapoff.org>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: Alec Thomas <alec@swapoff.org>
+
+
+"""A process pool with the same interface as ThreadPool."""
+
+
+__author__ = 'Alec Thomas <alec@swapoff.org>'
+
+
+import cPickle
+import logging
+import multiprocessing
+import sys
+
+from cut.threadpool import _Pool
+
+
+class ProcessPool(_Pool):
+    """Run callables in a pool of processes.
+
+    Each worker has its own interpreter and GIL, so CPU-bound work such as
+    serialization scales across cores. Use cut.threadpool.ThreadPool for
+    I/O-bound work.
+
+    Callables, arguments and return values must be picklable; if they are
+    not, WorkResult.get() raises the pickling error. Exceptions are re-raised
+    by WorkResult.get() without their original traceback.
+
+        >>> with ProcessPool(4) as pool:
+            ...     return pool.map(my_module_level_func, my_args)
+    """
+
+    def __init__(self, workers):
+        self._pool = multiprocessing.Pool(workers)
+
+    def _apply(self, result, callable, args, kwargs):
+        # multiprocessing silently drops requests it cannot pickle, which
+        # would leave result unset forever, so pickle the request here and
+        # send the bytes, which multiprocessing pickles trivially.
+        try:
+            request = cPickle.dumps((callable, args, kwargs),
+                                    cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            result._put(None, sys.exc_info())
+            return
+        self._pool.apply_async(_call, (request,),
+                               callback=lambda r: _put_result(result, r))
+
+    def shutdown(self):
+        """Shut the pool down, waiting for all workers to complete."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def _call(request):
+    """Run a pickled (callable, args, kwargs) request in a worker.
+
+    Returns pickled (value, exc_info). The outcome is pickled here rather than
+    by multiprocessing, so that an unpicklable value or exception is reported
+    instead of being dropped.
+    """
+    callable, args, kwargs = None, (), {}
+    try:
+        callable, args, kwargs = cPickle.loads(request)
+        outcome = callable(*args, **kwargs), None
+    except:
+        exc_info = sys.exc_info()
+        logging.error('ProcessPool worker %r(%r, %r) failed.',
+                      callable, args, kwargs, exc_info=exc_info)
+        # Tracebacks cannot be pickled back to the parent.
+        outcome = None, (exc_info[0], exc_info[1], None)
+    try:
+        return cPickle.dumps(outcome, cPickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        error = cPickle.PicklingError(
+            'Could not pickle result of %r: %s' % (callable, e))
+        return cPickle.dumps((None, (cPickle.PicklingError, error, None)),
+                             cPickle.HIGHEST_PROTOCOL)
+
+
+def _put_result(result, payload):
+    """Unpickle the outcome of _call() into result."""
+    try:
+        value, exc_info = cPickle.loads(payload)
+    except Exception:
+        value, exc_info = None, sys.exc_info()
+    result._put(value, exc_info)
@@ -0,0 +1,103 @@
+# encoding: utf-8
+#
+# Copyright (C) 2010 Alec Thomas <alec@swapoff.org>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: Alec Thomas <alec@swapoff.org>
+
+__author__ = 'Alec Thomas <alec@swapoff.org>'
+
+
+import cPickle
+import unittest
+from cut.processpool import ProcessPool
+
+
+def double(x):
+    return x * 2
+
+
+def fail(x):
+    raise ValueError(x)
+
+
+def unpicklable_result(x):
+    return lambda: x
+
+
+class UnpicklableError(Exception):
+    def __init__(self, a, b):
+        super(UnpicklableError, self).__init__(a)
+
+
+def fail_unpicklable(x):
+    raise UnpicklableError(x, x)
+
+
+class CountedPickle(object):
+    """Counts how many times it is pickled in this process."""
+
+    pickled = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        CountedPickle.pickled += 1
+        return CountedPickle, (self.value,)
+
+
+def unwrap(counted):
+    return counted.value
+
+
+class TestProcessPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ProcessPool(2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_apply(self):
+        self.assertEqual(self.pool.apply(double, 2), 4)
+
+    def test_apply_reraises(self):
+        self.assertRaises(ValueError, self.pool.apply_async(fail, 1).get, 5)
+
+    def test_map(self):
+        self.assertEqual(self.pool.map(double, range(5), timeout=5),
+                         [0, 2, 4, 6, 8])
+
+    def test_imap_unordered(self):
+        self.assertEqual(
+            sorted(self.pool.imap_unordered(double, range(5), timeout=5)),
+            [0, 2, 4, 6, 8])
+
+    def test_request_is_pickled_once(self):
+        CountedPickle.pickled = 0
+        self.assertEqual(self.pool.apply(unwrap, CountedPickle(3)), 3)
+        self.assertEqual(CountedPickle.pickled, 1)
+
+    def test_unpicklable_callable(self):
+        result = self.pool.apply_async(lambda x: x, 1)
+        self.assertRaises(cPickle.PicklingError, result.get, 5)
+
+    def test_unpicklable_result(self):
+        result = self.pool.apply_async(unpicklable_result, 1)
+        self.assertRaises(cPickle.PicklingError, result.get, 5)
+
+    def test_unpicklable_exception(self):
+        # Pickles in the worker but cannot be rebuilt in the parent.
+        result = self.pool.apply_async(fail_unpicklable, 1)
+        self.assertRaises(TypeError, result.get, 5)
+
+    def test_map_unpicklable_does_not_hang(self):
+        self.assertEqual(self.pool.map(lambda x: x, range(2), timeout=5),
+                         [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
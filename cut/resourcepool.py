@@ -15,7 +15,7 @@
 __author__ = 'Alec Thomas <alec@swapoff.org>'
 
 
-from Queue import Queue
+from cut.simplequeue import SimpleQueue
 
 
 class Resource(object):
@@ -58,7 +58,7 @@ class ResourcePool(object):
 
     def __init__(self, resources):
         """Create a new resource pool populated with resources."""
-        self._resources = Queue()
+        self._resources = SimpleQueue()
         for resource in resources:
             self._resources.put(resource)
 
@@ -22,6 +22,31 @@ __author__ = 'Alec Thomas <alec@swapoff.org>'
 from abc import ABCMeta, abstractmethod
 import collections
 import json
+import re
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Registry of Serializable types, keyed by lowercased class name.
+_serializable = {}
+# Callables creating an instance from serialized state, keyed as above.
+_factories = {}
+
+
+def _make_factory(cls):
+    """Build a callable creating an instance of cls from serialized state.
+
+    The instance is created without calling __init__, then restored by
+    __deserialize__, which every Serializable has.
+    """
+    def factory(state):
+        instance = cls.__new__(cls)
+        instance.__deserialize__(state)
+        return instance
+    return factory
 
 
 class SerializableMeta(type):
@@ -30,6 +55,16 @@ class SerializableMeta(type):
         assert name.lower() not in _serializable, \
                 'serialized types must have globally unique names'
         _serializable[name.lower()] = cls
+        _factories[name.lower()] = _make_factory(cls)
+        # Generate a serializer for classes declaring __fields__, or
+        # inheriting them along with the default __serialize__, but never
+        # replace an inherited hand-written __serialize__.
+        fields = getattr(cls, '__fields__', None)
+        if fields is not None and '__serialize__' not in dict and (
+                '__fields__' in dict or
+                cls.__serialize__.im_func is Serializable.__dict__[
+                    '__serialize__']):
+            cls.__serialize__ = _compile_serializer(fields)
         return cls
 
 
@@ -38,15 +73,25 @@ class Serializable(object):
 
     The serialized state is a copy of the objects __dict__ consisting of only
     public attributes.
+
+    Subclasses may instead set __fields__ to a sequence of attribute names,
+    in which case a __serialize__ method returning exactly those attributes
+    is generated for the class, avoiding the per-call copy of __dict__.
+
+    Subclasses may set PROTO to a generated Protocol Buffers message class
+    whose fields match the serialized state. Top-level instances are then
+    serialized as that message rather than through the Serializer's codec.
     """
     __metaclass__ = SerializableMeta
 
+    # Empty, so that subclasses declaring __slots__ have no __dict__.
+    __slots__ = ()
+
+    PROTO = None
+
     def __serialize__(self):
-        state = self.__dict__.copy()
-        for key in state.keys():
-            if key.startswith('_'):
-                del state[key]
-        return state
+        return {key: value for key, value in self.__dict__.iteritems()
+                if not key.startswith('_')}
 
     def __deserialize__(self, state):
         self.__dict__.update(state)
@@ -57,46 +102,137 @@ class Serializer(object):
         self.impl = impl
 
     def serialize(self, data):
+        if getattr(data, 'PROTO', None) is not None:
+            return _proto_dumps(data)
         return self.impl.dumps(_to_pod(data))
 
     def deserialize(self, raw):
+        if raw[:1] == _PROTO_TAG:
+            return _proto_loads(raw)
         return _from_pod(self.impl.loads(raw))
 
 
+class JSONCodec(object):
+    """A compact JSON implementation for Serializer."""
+
+    # Shared instances avoid constructing an encoder per call, and are safe
+    # across threads as they hold no per-call state. The stdlib is used
+    # rather than ujson, which rounds floats to at most 15 digits and cannot
+    # encode integers beyond 64 bits, so would not round-trip all values.
+    _encoder = json.JSONEncoder(separators=(',', ':'))
+    _decoder = json.JSONDecoder()
+    dumps = staticmethod(_encoder.encode)
+    loads = staticmethod(_decoder.decode)
+
+
+class MsgPackCodec(object):
+    """A MessagePack implementation for Serializer.
+
+    Byte strings are packed as binary and unicode as UTF-8 strings, so both
+    survive a round-trip intact. Type envelopes and field names produced by
+    _to_pod() are unicode, so other languages see them as text.
+    """
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('MsgPackCodec requires the msgpack package')
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw):
+        return msgpack.unpackb(raw, raw=False)
+
+
+def _compile_serializer(fields):
+    """Generate a __serialize__ method returning the named attributes."""
+    for field in fields:
+        assert re.match(r'^[A-Za-z_]\w*$', field), \
+                'invalid serialized field name %r' % field
+    items = ', '.join('%r: self.%s' % (field, field) for field in fields)
+    namespace = {}
+    exec 'def __serialize__(self):\n    return {%s}\n' % items in namespace
+    return namespace['__serialize__']
+
+
 def _to_pod(instance):
     """Convert from a nested data structure with classes, to a POD."""
+    # Exact-type fast paths for the common containers. Leaves are tested
+    # inline to avoid a recursive call per primitive.
+    cls = type(instance)
+    if cls in _PRIMITIVES:
+        return instance
+    if cls is list or cls is tuple:
+        return [v if type(v) in _PRIMITIVES else _to_pod(v)
+                for v in instance]
+    if cls is dict:
+        return dict((k, v if type(v) in _PRIMITIVES else _to_pod(v))
+                    for k, v in instance.iteritems())
+    if hasattr(instance, '__serialize__'):
+        # Envelope keys, type names and field names are always text.
+        state = dict((_text(k), _to_pod(v))
+                     for k, v in instance.__serialize__().iteritems())
+        return {u'__type__': _text(cls.__name__.lower()), u'state': state}
     if isinstance(instance, dict):
-        if hasattr(instance, '__serialize__'):
-            state = instance.__serialize__()
-            type = instance.__class__.__name__.lower()
-            instance = {'__type__': type, 'state': state}
-        else:
-            for k, v in instance.iteritems():
-                instance[k] = _to_pod(v)
-    elif isinstance(instance, collections.Iterable):
-        return map(_to_pod, instance)
+        return dict((k, _to_pod(v)) for k, v in instance.iteritems())
+    if isinstance(instance, basestring):
+        return instance
+    if isinstance(instance, collections.Iterable):
+        return [_to_pod(v) for v in instance]
     return instance
 
 
+def _text(s):
+    """Convert a byte string to unicode, leaving other values alone."""
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return s
+
+
+def _proto_dumps(instance):
+    """Serialize instance as its PROTO message, tagged with its type name."""
+    pb = instance.PROTO(**instance.__serialize__())
+    type = instance.__class__.__name__.lower()
+    return _PROTO_TAG + type + ':' + pb.SerializeToString()
+
+
+def _proto_loads(raw):
+    """Inverse of _proto_dumps()."""
+    type, payload = raw[1:].split(':', 1)
+    pb = _serializable[type].PROTO.FromString(payload)
+    state = {}
+    for field in pb.DESCRIPTOR.fields:
+        value = getattr(pb, field.name)
+        if field.label == field.LABEL_REPEATED:
+            value = list(value)
+        state[field.name] = value
+    return _factories[type](state)
+
+
 def _from_pod(pod):
     """Recursively convert from POD to complex structures."""
+    # See _to_pod() for the fast paths.
+    cls = type(pod)
+    if cls in _PRIMITIVES:
+        return pod
+    if cls is list:
+        return [v if type(v) in _PRIMITIVES else _from_pod(v) for v in pod]
     if isinstance(pod, dict):
-        type = pod.get('__type__', None)
-        if type is not None:
-            cls = globals()[type]
-            if hasattr(cls, '__deserialize__'):
-                instance = cls.__new__(cls)
-                instance.__deserialize__(pod['state'])
-                return instance
-            else:
-                kwargs = dict((str(k), v) for k, v in pod['state'].iteritems())
-                return cls(**kwargs)
-        else:
-            for key, value in pod.iteritems():
-                pod[key] = _from_pod(value)
-    elif isinstance(pod, collections.Iterable):
-        return map(_from_pod, pod)
+        type_name = pod.get('__type__', None)
+        if type_name is not None:
+            return _factories[type_name](_from_pod(pod['state']))
+        return dict((k, v if type(v) in _PRIMITIVES else _from_pod(v))
+                    for k, v in pod.iteritems())
+    if isinstance(pod, basestring):
+        return pod
+    if isinstance(pod, collections.Iterable):
+        return [_from_pod(v) for v in pod]
     return pod
 
 
-_serializable = {}
+# Leaf types returned as-is by _to_pod() and _from_pod().
+_PRIMITIVES = frozenset([int, long, float, bool, type(None), str, unicode])
+
+# Leading byte of Protocol Buffers payloads. 0xc1 is never emitted by
+# MessagePack and cannot start UTF-8 text, so it cannot collide with a codec.
+_PROTO_TAG = '\xc1'
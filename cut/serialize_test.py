@@ -13,33 +13,256 @@ __author__ = 'Alec Thomas <alec@swapoff.org>'
 
 import json
 import unittest
-from cut.serialize import Serializable, Serializer
+from cut.serialize import JSONCodec, MsgPackCodec, Serializable, \
+    Serializer, _PROTO_TAG, _from_pod, msgpack
 
 
-class MyCustomObject(
+class MyCustomObject(Serializable):
+    def __init__(self, name, child=None):
+        self.name = name
+        self.child = child
+        self._private = 'hidden'
+
+
+class Point(Serializable):
+    __fields__ = ('x', 'y')
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self._norm = None
+
+
+class CustomState(Serializable):
+    def __serialize__(self):
+        return {'value': self.value * 10}
+
+    def __deserialize__(self, state):
+        self.value = state['value'] // 10
+
+
+class TaggedPoint(Serializable):
+    __fields__ = ('x',)
+
+    def __init__(self, x=0):
+        self.x = x
+
+    def __serialize__(self):
+        return {'x': self.x, 'tag': 'point'}
+
+
+class SubTaggedPoint(TaggedPoint):
+    pass
+
+
+class FakeField(object):
+    """Stand-in for a protobuf FieldDescriptor."""
+
+    LABEL_OPTIONAL = 1
+    LABEL_REPEATED = 3
+
+    def __init__(self, name, label=LABEL_OPTIONAL):
+        self.name = name
+        self.label = label
+
+
+class FakePointMessage(object):
+    """Stand-in for a generated protobuf message class."""
+
+    class DESCRIPTOR(object):
+        fields = [FakeField('x'),
+                  FakeField('tags', FakeField.LABEL_REPEATED)]
+
+    def __init__(self, x=0, tags=()):
+        self.x = x
+        # Repeated fields are containers, not lists.
+        self.tags = tuple(tags)
+
+    def SerializeToString(self):
+        return json.dumps({'x': self.x, 'tags': self.tags})
+
+    @classmethod
+    def FromString(cls, raw):
+        return cls(**dict((str(k), v) for k, v in json.loads(raw).items()))
+
+
+class ProtoPoint(Serializable):
+    PROTO = FakePointMessage
+    __fields__ = ('x', 'tags')
+
+    def __init__(self, x, tags):
+        self.x = x
+        self.tags = tags
 
 
 class TestSerialization(unittest.TestCase):
-    EXPECTED_JSON = '{"__type__": "Lock", "state": {"key": "test"}}'
+    EXPECTED_JSON = {'__type__': 'mycustomobject',
+                     'state': {'name': 'test', 'child': None}}
     EXPECTED_POD_JSON = '[1, "hello"]'
 
     s = Serializer(json)
 
-    def testdumps_distributed_primitive(self):
-        lock = Lock('test')
-        self.assertEqual(dumps(lock), self.EXPECTED_JSON)
+    def testdumps_custom_object(self):
+        raw = self.s.serialize(MyCustomObject('test'))
+        self.assertEqual(json.loads(raw), self.EXPECTED_JSON)
 
-    def testloads_distributed_primitive(self):
-        expected_lock = Lock('test')
-        lock = loads(self.EXPECTED_JSON)
-        self.assertTrue(isinstance(lock, Lock))
-        self.assertEqual(lock.key, expected_lock.key)
+    def testloads_custom_object(self):
+        obj = self.s.deserialize(json.dumps(self.EXPECTED_JSON))
+        self.assertTrue(isinstance(obj, MyCustomObject))
+        self.assertEqual(obj.name, 'test')
 
     def testdumps_pod(self):
-        self.assertEqual(dumps([1, 'hello']), self.EXPECTED_POD_JSON)
+        self.assertEqual(self.s.serialize([1, 'hello']),
+                         self.EXPECTED_POD_JSON)
 
     def testloads_pod(self):
-        self.assertEqual(loads(self.EXPECTED_POD_JSON), [1, 'hello'])
+        self.assertEqual(self.s.deserialize(self.EXPECTED_POD_JSON),
+                         [1, 'hello'])
+
+    def test_string_leaves_are_not_expanded(self):
+        data = ['hello', u'wörld', {'key': 'value'}, ('a', u'b')]
+        self.assertEqual(self.s.deserialize(self.s.serialize(data)),
+                         ['hello', u'wörld', {'key': 'value'}, ['a', u'b']])
+
+    def test_nested_serializable_round_trip(self):
+        obj = MyCustomObject('outer', MyCustomObject('inner'))
+        copy = self.s.deserialize(self.s.serialize({'obj': [obj]}))['obj'][0]
+        self.assertTrue(isinstance(copy, MyCustomObject))
+        self.assertEqual(copy.name, 'outer')
+        self.assertTrue(isinstance(copy.child, MyCustomObject))
+        self.assertEqual(copy.child.name, 'inner')
+
+    def test_private_attributes_are_not_serialized(self):
+        raw = self.s.serialize(MyCustomObject('test'))
+        self.assertTrue('_private' not in raw)
+
+    def test_serialize_does_not_mutate_input(self):
+        child = MyCustomObject('child')
+        data = {'obj': child, 'list': [child], 'nested': {'obj': child}}
+        self.s.serialize(data)
+        self.assertTrue(data['obj'] is child)
+        self.assertTrue(data['list'][0] is child)
+        self.assertTrue(data['nested']['obj'] is child)
+
+    def test_deserialize_does_not_mutate_pod(self):
+        pod = {'obj': self.EXPECTED_JSON}
+        _from_pod(pod)
+        self.assertEqual(pod['obj'], self.EXPECTED_JSON)
+
+
+class TestRegistry(unittest.TestCase):
+    s = Serializer(json)
+
+    def test_fields_generate_serializer(self):
+        self.assertEqual(Point(1, 2).__serialize__(), {'x': 1, 'y': 2})
+
+    def test_fields_do_not_replace_inherited_serializer(self):
+        self.assertEqual(SubTaggedPoint(1).__serialize__(),
+                         {'x': 1, 'tag': 'point'})
+
+    def test_loads_user_type_envelope(self):
+        raw = '{"__type__": "point", "state": {"x": 1, "y": [2, 3]}}'
+        point = self.s.deserialize(raw)
+        self.assertTrue(isinstance(point, Point))
+        self.assertEqual((point.x, point.y), (1, [2, 3]))
+
+    def test_fields_round_trip(self):
+        point = self.s.deserialize(self.s.serialize(Point(1, 'two')))
+        self.assertTrue(isinstance(point, Point))
+        self.assertEqual((point.x, point.y), (1, 'two'))
+
+    def test_custom_deserialize_is_used(self):
+        obj = CustomState()
+        obj.value = 4
+        raw = self.s.serialize(obj)
+        self.assertEqual(json.loads(raw)['state'], {'value': 40})
+        self.assertEqual(self.s.deserialize(raw).value, 4)
+
+    def test_unknown_type_raises(self):
+        self.assertRaises(KeyError, self.s.deserialize,
+                          '{"__type__": "nosuchtype", "state": {}}')
+
+
+class TestProto(unittest.TestCase):
+    s = Serializer(JSONCodec())
+
+    def test_tagged_with_type_name(self):
+        raw = self.s.serialize(ProtoPoint(1, ['a']))
+        self.assertTrue(raw.startswith(_PROTO_TAG + 'protopoint:'))
+
+    def test_round_trip(self):
+        point = self.s.deserialize(self.s.serialize(ProtoPoint(1, ['a', 'b'])))
+        self.assertTrue(isinstance(point, ProtoPoint))
+        self.assertEqual(point.x, 1)
+        # Repeated fields are converted back to lists.
+        self.assertEqual(point.tags, ['a', 'b'])
+        self.assertTrue(isinstance(point.tags, list))
+
+    def test_nested_values_use_codec(self):
+        raw = self.s.serialize([ProtoPoint(1, [])])
+        self.assertFalse(raw.startswith(_PROTO_TAG))
+        self.assertTrue(isinstance(self.s.deserialize(raw)[0], ProtoPoint))
+
+    def test_json_never_matches_tag(self):
+        for value in [1, 'a', u'\u2603', [], {}, None, 1.5, True]:
+            self.assertNotEqual(self.s.serialize(value)[:1], _PROTO_TAG)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_never_matches_tag(self):
+        s = Serializer(MsgPackCodec())
+        values = [0, 1, -1, 127, 128, 2 ** 40, -2 ** 40, 1.5, None, True,
+                  False, '', 'x' * 300, u'', u'\u2603', [], [1] * 20, {},
+                  dict((str(i), i) for i in range(20)), MyCustomObject('a')]
+        for value in values:
+            raw = s.serialize(value)
+            self.assertNotEqual(raw[:1], _PROTO_TAG, repr(value))
+
+
+class TestJSONCodec(unittest.TestCase):
+    def setUp(self):
+        self.s = Serializer(JSONCodec())
+
+    def test_output_is_compact(self):
+        self.assertEqual(JSONCodec.dumps({'a': [1, 2]}), '{"a":[1,2]}')
+
+    def test_round_trip(self):
+        data = {u'a': [1, 2.5, None, True], u'b': u'text \u2603'}
+        self.assertEqual(self.s.deserialize(self.s.serialize(data)), data)
+
+    def test_round_trip_serializable(self):
+        raw = self.s.serialize(Point(1, 2))
+        self.assertNotIn(' ', raw)
+        point = self.s.deserialize(raw)
+        self.assertTrue(isinstance(point, Point))
+        self.assertEqual((point.x, point.y), (1, 2))
+
+
+@unittest.skipIf(msgpack is None, 'msgpack is not installed')
+class TestMsgPackCodec(unittest.TestCase):
+    def setUp(self):
+        self.s = Serializer(MsgPackCodec())
+
+    def test_round_trip_preserves_bytes_and_unicode(self):
+        data = ['bytes\xff', u'text \u2603', 1, None, [2.5]]
+        copy = self.s.deserialize(self.s.serialize(data))
+        self.assertEqual(copy, data)
+        self.assertTrue(isinstance(copy[0], str))
+        self.assertTrue(isinstance(copy[1], unicode))
+
+    def test_envelope_keys_are_text(self):
+        raw = self.s.serialize(MyCustomObject('test'))
+        # Unpacked without decoding, text comes back as unicode and binary
+        # as str.
+        pod = msgpack.unpackb(raw, raw=False)
+        self.assertEqual(sorted(map(type, pod.keys())), [unicode, unicode])
+        self.assertTrue(isinstance(pod[u'__type__'], unicode))
+        self.assertTrue(all(isinstance(k, unicode) for k in pod[u'state']))
+        self.assertTrue(isinstance(pod[u'state'][u'name'], str))
+
+    def test_round_trip_serializable(self):
+        obj = self.s.deserialize(self.s.serialize(MyCustomObject('test')))
+        self.assertTrue(isinstance(obj, MyCustomObject))
+        self.assertEqual(obj.name, 'test')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+# encoding: utf-8
+#
+# Copyright (C) 2010 Alec Thomas <alec@swapoff.org>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: Alec Thomas <alec@swapoff.org>
+
+
+"""An unbounded thread-safe FIFO queue."""
+
+
+__author__ = 'Alec Thomas <alec@swapoff.org>'
+
+
+import threading
+import time
+
+from collections import deque
+from Queue import Empty
+
+
+class SimpleQueue(object):
+    """An unbounded FIFO queue.
+
+    A lighter alternative to Queue.Queue for producer/consumer use: there is
+    no maxsize or task tracking, so each operation is a single deque call
+    under one condition variable.
+    """
+
+    def __init__(self):
+        self._items = deque()
+        self._cond = threading.Condition(threading.Lock())
+
+    def put(self, item):
+        """Put an item on the queue."""
+        with self._cond:
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return an item from the queue.
+
+        :param block: Wait for an item if the queue is empty.
+        :param timeout: If blocking, the maximum time in seconds to wait.
+
+        :raises Empty: No item was available.
+        """
+        with self._cond:
+            self._wait(block, timeout)
+            return self._items.popleft()
+
+    def get_many(self, n, block=True, timeout=None):
+        """Remove and return up to n items from the queue.
+
+        Waits as get() does for the first item, then takes whatever else is
+        available under the same lock acquisition.
+
+        :raises Empty: No item was available.
+        :raises ValueError: n is less than 1.
+        """
+        if n < 1:
+            raise ValueError('n must be at least 1, not %r' % n)
+        with self._cond:
+            self._wait(block, timeout)
+            popleft = self._items.popleft
+            return [popleft() for _ in xrange(min(n, len(self._items)))]
+
+    def get_nowait(self):
+        """Remove and return an item without blocking."""
+        return self.get(False)
+
+    def _wait(self, block, timeout):
+        """Wait for an item to be available. Must hold self._cond."""
+        if not self._items and block:
+            if timeout is None:
+                while not self._items:
+                    self._cond.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self._items:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+        if not self._items:
+            raise Empty()
+
+    def qsize(self):
+        """Approximate number of items in the queue."""
+        return len(self._items)
+
+    def empty(self):
+        """Check if the queue is empty. This is a rough guide only."""
+        return not self._items
@@ -0,0 +1,56 @@
+# encoding: utf-8
+#
+# Copyright (C) 2010 Alec Thomas <alec@swapoff.org>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: Alec Thomas <alec@swapoff.org>
+
+__author__ = 'Alec Thomas <alec@swapoff.org>'
+
+
+import threading
+import unittest
+from Queue import Empty
+from cut.simplequeue import SimpleQueue
+
+
+class TestSimpleQueue(unittest.TestCase):
+    def test_fifo(self):
+        q = SimpleQueue()
+        for i in range(3):
+            q.put(i)
+        self.assertEqual([q.get() for _ in range(3)], [0, 1, 2])
+        self.assertTrue(q.empty())
+
+    def test_get_many(self):
+        q = SimpleQueue()
+        for i in range(5):
+            q.put(i)
+        self.assertEqual(q.get_many(3), [0, 1, 2])
+        self.assertEqual(q.get_many(3), [3, 4])
+        self.assertRaises(Empty, q.get_many, 3, False)
+
+    def test_get_many_rejects_non_positive(self):
+        q = SimpleQueue()
+        q.put(1)
+        self.assertRaises(ValueError, q.get_many, 0)
+        self.assertRaises(ValueError, q.get_many, -1)
+        self.assertEqual(q.qsize(), 1)
+
+    def test_get_nowait_empty(self):
+        self.assertRaises(Empty, SimpleQueue().get_nowait)
+
+    def test_get_timeout(self):
+        self.assertRaises(Empty, SimpleQueue().get, True, 0.01)
+
+    def test_get_wakes_on_put(self):
+        q = SimpleQueue()
+        threading.Timer(0.01, q.put, ['hello']).start()
+        self.assertEqual(q.get(timeout=5), 'hello')
+
+
+if __name__ == '__main__':
+    unittest.main()
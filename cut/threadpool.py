@@ -19,18 +19,30 @@ import logging
 import threading
 import sys
 
+from abc import ABCMeta, abstractmethod
 from collections import namedtuple
-from Queue import Queue, Empty
+from Queue import Empty
+
+from cut.simplequeue import SimpleQueue
 
 
 WorkRequest = namedtuple('WorkRequest', 'callable args kwargs result')
 
 
 class WorkResult(object):
-    """Result of a request to the thread pool."""
+    """Result of a request to the thread pool.
+
+    :param completed: Optional queue that (index, result) is put on when
+                      the result is ready.
+    :param index: Position of the request, used with completed.
+    """
+
+    __slots__ = ('_ready', '_completed', '_index', 'value', 'exc_info')
 
-    def __init__(self):
+    def __init__(self, completed=None, index=None):
         self._ready = threading.Event()
+        self._completed = completed
+        self._index = index
 
     def get(self, timeout=None):
         """Get worker result.
@@ -72,25 +84,16 @@ class WorkResult(object):
         self.value = value
         self.exc_info = exc_info
         self._ready.set()
+        if self._completed is not None:
+            self._completed.put((self._index, self))
 
 
-class ThreadPool(object):
-    """Run callables in a pool of threads.
-
-    May be used as a context manager for transient pools:
+class _Pool(object):
+    """Common interface for worker pools.
 
-        >>> with ThreadPool(10) as pool:
-            ...     return pool.map(MyFunc, my_args)
+    Subclasses implement _apply() and shutdown().
     """
-
-    def __init__(self, workers):
-        self._requests = Queue()
-        self._results = {}
-        self._workers = [threading.Thread(target=self._worker)
-                         for _ in range(workers)]
-        for worker in self._workers:
-            worker.setDaemon(True)
-            worker.start()
+    __metaclass__ = ABCMeta
 
     def __enter__(self):
         return self
@@ -103,46 +106,120 @@ class ThreadPool(object):
 
         Returns a sequence of return values from callable.
 
-        If a timeout is reached on any individual call, or an exception is
-        raised, the resulting value in the sequence will be None.
+        Results are collected in completion order, so a slow call does not
+        hold up reaping the others. If no call completes within timeout
+        seconds, or an exception is raised, the resulting value in the
+        sequence will be None.
         """
-        work_results = [self.apply(callable, element) for element in sequence]
-        results = []
-        for result in work_results:
+        completed = SimpleQueue()
+        count = self._submit(callable, sequence, completed)
+        results = [None] * count
+        for _ in xrange(count):
             try:
-                results.append(result.get(timeout=timeout))
+                index, result = completed.get(timeout=timeout)
+            except Empty:
+                break
+            try:
+                results[index] = result.get()
             except:
-                results.append(None)
+                pass
         return results
 
+    def imap_unordered(self, callable, sequence, timeout=None):
+        """Call callable with each element of sequence.
+
+        Yields return values in the order calls complete. Exceptions from
+        callable are re-raised.
+
+        :raises Empty: No call completed within timeout seconds.
+        """
+        completed = SimpleQueue()
+        for _ in xrange(self._submit(callable, sequence, completed)):
+            _, result = completed.get(timeout=timeout)
+            yield result.get()
+
     def map_async(self, callable, sequence, timeout=None):
         """Call callable with each element of sequence.
 
         :returns: A list of WorkResult objects.
         """
-        return [self.apply(callable, element, timeout=timeout)
-                for element in sequence]
+        return [self.apply_async(callable, element) for element in sequence]
 
     def apply(self, callable, *args, **kwargs):
-        """Run a function in a thread.
+        """Run a function in a worker.
 
         :returns: Result of function call.
         """
         return self.apply_async(callable, *args, **kwargs).get()
 
     def apply_async(self, callable, *args, **kwargs):
-        """Run a function in a thread.
+        """Run a function in a worker.
 
         :returns: WorkResult object.
         """
         result = WorkResult()
-        request = WorkRequest(callable, args, kwargs, result)
-        self._requests.put(request)
+        self._apply(result, callable, args, kwargs)
         return result
 
+    def _submit(self, callable, sequence, completed):
+        """Apply callable to each element, reporting to completed.
+
+        :returns: Number of calls submitted.
+        """
+        count = 0
+        for index, element in enumerate(sequence):
+            self._apply(WorkResult(completed, index), callable, (element,), {})
+            count += 1
+        return count
+
+    @abstractmethod
+    def _apply(self, result, callable, args, kwargs):
+        """Schedule callable(*args, **kwargs), recording it in result."""
+
     def __del__(self):
         self.shutdown()
 
+    @abstractmethod
+    def shutdown(self):
+        """Shut the pool down, waiting for all workers to complete."""
+
+
+class ThreadPool(_Pool):
+    """Run callables in a pool of threads.
+
+    Threads share the GIL, so this is best suited to I/O-bound work such as
+    talking to Redis. Use cut.processpool.ProcessPool for CPU-bound work.
+
+    May be used as a context manager for transient pools:
+
+        >>> with ThreadPool(10) as pool:
+            ...     return pool.map(MyFunc, my_args)
+
+    :param workers: Number of worker threads.
+    :param batch_size: Maximum number of queued requests a worker claims at
+                       once. Larger batches amortize queue locking for very
+                       short tasks, but a worker runs its batch serially, so
+                       a slow task holds up the rest of its batch even while
+                       other workers are idle. Defaults to 1.
+    :raises ValueError: batch_size is less than 1.
+    """
+
+    def __init__(self, workers, batch_size=1):
+        if batch_size < 1:
+            raise ValueError(
+                'batch_size must be at least 1, not %r' % batch_size)
+        self._requests = SimpleQueue()
+        self._results = {}
+        self._batch_size = batch_size
+        self._workers = [threading.Thread(target=self._worker)
+                         for _ in range(workers)]
+        for worker in self._workers:
+            worker.setDaemon(True)
+            worker.start()
+
+    def _apply(self, result, callable, args, kwargs):
+        self._requests.put(WorkRequest(callable, args, kwargs, result))
+
     def shutdown(self):
         """Shut the pool down, waiting for all workers to complete."""
         for _ in self._workers:
@@ -153,16 +230,23 @@ class ThreadPool(object):
 
     def _worker(self):
         while True:
-            request = self._requests.get()
-            if request is None:
-                break
-            try:
-                value = request.callable(*request.args, **request.kwargs)
-                request.result._put(value, None)
-            except:
-                exc_info = sys.exc_info()
-                # Exceptions are re-raised in receiver.
-                logging.error('ThreadPool worker %r(%r, %r) failed.',
-                              request.callable, request.args, request.kwargs,
-                              exc_info=exc_info)
-                request.result._put(None, exc_info)
+            requests = self._requests.get_many(self._batch_size)
+            for i, request in enumerate(requests):
+                if request is None:
+                    # Return anything claimed after our shutdown sentinel.
+                    for request in requests[i + 1:]:
+                        self._requests.put(request)
+                    return
+                self._run(request)
+
+    def _run(self, request):
+        try:
+            value = request.callable(*request.args, **request.kwargs)
+            request.result._put(value, None)
+        except:
+            exc_info = sys.exc_info()
+            # Exceptions are re-raised in receiver.
+            logging.error('ThreadPool worker %r(%r, %r) failed.',
+                          request.callable, request.args, request.kwargs,
+                          exc_info=exc_info)
+            request.result._put(None, exc_info)
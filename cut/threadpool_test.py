@@ -0,0 +1,89 @@
+# encoding: utf-8
+#
+# Copyright (C) 2010 Alec Thomas <alec@swapoff.org>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# Author: Alec Thomas <alec@swapoff.org>
+
+__author__ = 'Alec Thomas <alec@swapoff.org>'
+
+
+import time
+import unittest
+from cut.threadpool import ThreadPool
+
+
+def noop():
+    pass
+
+
+def double(x):
+    if x == 0:
+        time.sleep(0.1)
+    return x * 2
+
+
+def fail(x):
+    raise ValueError(x)
+
+
+class TestThreadPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPool(4)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_apply(self):
+        self.assertEqual(self.pool.apply(double, 2), 4)
+
+    def test_apply_reraises(self):
+        self.assertRaises(ValueError, self.pool.apply, fail, 1)
+
+    def test_map_preserves_order(self):
+        self.assertEqual(self.pool.map(double, range(8)),
+                         [x * 2 for x in range(8)])
+
+    def test_map_failures_are_none(self):
+        self.assertEqual(self.pool.map(fail, range(3)), [None, None, None])
+
+    def test_imap_unordered_yields_in_completion_order(self):
+        values = list(self.pool.imap_unordered(double, range(4)))
+        self.assertEqual(sorted(values), [0, 2, 4, 6])
+        # The slow first call completes last.
+        self.assertEqual(values[-1], 0)
+
+    def test_map_async(self):
+        results = self.pool.map_async(double, range(3))
+        self.assertEqual([r.get(5) for r in results], [0, 2, 4])
+
+
+class TestThreadPoolBatching(unittest.TestCase):
+    def test_slow_tasks_run_in_parallel(self):
+        # A worker must not claim queued slow tasks that idle workers could
+        # be running. Busy workers first, so the backlog builds up.
+        with ThreadPool(4) as pool:
+            start = time.time()
+            results = [pool.apply_async(time.sleep, 0.2) for _ in range(4)]
+            results += [pool.apply_async(time.sleep, 0.5) for _ in range(4)]
+            results += [pool.apply_async(noop) for _ in range(60)]
+            for result in results:
+                result.get(5)
+            # 0.7s when run in parallel, at least 1.2s if serialized.
+            self.assertLess(time.time() - start, 1.1)
+
+    def test_batched_workers_complete_all_requests(self):
+        with ThreadPool(4, batch_size=8) as pool:
+            self.assertEqual(pool.map(double, range(1, 100)),
+                             [x * 2 for x in range(1, 100)])
+
+    def test_batch_size_must_be_positive(self):
+        self.assertRaises(ValueError, ThreadPool, 1, batch_size=0)
+        self.assertRaises(ValueError, ThreadPool, 1, batch_size=-1)
+
+
+if __name__ == '__main__':
+    unittest.main()